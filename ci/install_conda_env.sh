@@ -6,3 +6,4 @@ source activate stemming
 
 echo "Installing packages..."
 conda install flask flake8 pytest
+pip install flask-compress
@@ -4,11 +4,16 @@ CREATE TABLE documents (
   doc_id TEXT NOT NULL,
   doc_text TEXT NOT NULL
 );
+CREATE UNIQUE INDEX documents_doc_id ON documents (doc_id);
 
 DROP TABLE IF EXISTS matches;
 CREATE TABLE matches (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   doc_id TEXT NOT NULL,
   stem TEXT NOT NULL,
-  matches TEXT NOT NULL
+  stem_count INTEGER NOT NULL,
+  matches TEXT NOT NULL,
+  highlighted BLOB
 );
+CREATE UNIQUE INDEX matches_doc_id_stem ON matches (doc_id, stem);
+CREATE INDEX matches_doc_id_stem_count ON matches (doc_id, stem_count DESC, stem DESC);
@@ -2,31 +2,61 @@
 Main stemming functionality.
 """
 
+from collections import OrderedDict
+
+import functools
+import heapq
 import os
 import sys
 
+# Characters stripped from either end of a word before stemming.
+_EXTRANEOUS_CHARS = " \t\n\r!?.,()@#&*^\"\'~[]"
+
 
-def memoize(f):
+def memoize(f=None, maxsize=None):
     """
     Memoize a function.
 
+    This can be applied directly as a decorator, or called with `maxsize`
+    to produce a decorator whose cache is bounded.
+
     Parameters
     ----------
-    f : callable
+    f : callable, optional
         The function that we are to memoize.
+    maxsize : int, optional
+        The maximum number of results to cache. Once the cache is full, the
+        least recently used result is evicted to make room. If not provided,
+        the cache can grow without bound.
 
     Returns
     -------
     memo_f : callable
-        The memoized version of `f`.
+        The memoized version of `f`, or a decorator that memoizes a function
+        if `f` is not provided.
     """
 
-    cache = {}
+    if f is None:
+        return functools.partial(memoize, maxsize=maxsize)
 
+    cache = OrderedDict()
+    kwargs_marker = object()
+
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        key = args + tuple(kwargs.keys()) + tuple(kwargs)
+        key = args
+
+        if kwargs:
+            key += (kwargs_marker,) + tuple(sorted(kwargs.items()))
+
+        if key in cache:
+            # Move the result to the end, so
+            # that it is evicted the latest.
+            cache[key] = cache.pop(key)
+        else:
+            if maxsize is not None and len(cache) >= maxsize:
+                cache.popitem(last=False)
 
-        if key not in cache:
             cache[key] = f(*args, **kwargs)
 
         return cache[key]
@@ -34,29 +64,44 @@ def memoize(f):
     return wrapper
 
 
-def get_top_stems(stem_mappings):
+def get_top_stems(stem_mappings, k=25):
     """
-    Get the top 25 stems or words found in a document.
+    Get the top `k` stems or words found in a document.
+
+    Stems tied in count with the `k`-th stem are kept as well, so more than
+    `k` stems can be returned.
 
     Parameters
     ----------
     stem_mappings : dict
-        The stem mappings from which
+        The stem mappings from which to choose the top stems, mapping each
+        stem to the list of words whose stem was the same.
+    k : int, default 25
+        The number of top stems to choose.
+
+    Returns
+    -------
+    top_stems : list
+        A list of (stem, count) tuples, sorted by count and then by stem in
+        descending order.
     """
 
-    stems = list(stem_mappings.keys())
-    stem_counts = {stem: len(stem_mappings[stem]) for stem in stem_mappings}
+    def stem_key(stem):
+        return len(stem_mappings[stem]), stem
+
+    stems = heapq.nlargest(k, stem_mappings, key=stem_key)
 
-    stems.sort(key=lambda k: (stem_counts[k], k), reverse=True)
+    if stems and len(stem_mappings) > k:
+        top_stems = set(stems)
+        bottom_count = len(stem_mappings[stems[-1]])
 
-    if len(stems) > 25:
-        bottom_count = len(stem_mappings[stems[24]])
-        stems = [(stem, stem_counts[stem]) for stem in stems
-                 if stem_counts[stem] >= bottom_count]
-    else:
-        stems = [(stem, stem_counts[stem]) for stem in stems]
+        # Anything not in the top k that ties with the k-th stem can
+        # only come after it, i.e. it has the same count but sorts lower.
+        tied_stems = [stem for stem in stem_mappings if stem not in top_stems
+                      and len(stem_mappings[stem]) == bottom_count]
+        stems.extend(sorted(tied_stems, reverse=True))
 
-    return stems
+    return [(stem, len(stem_mappings[stem])) for stem in stems]
 
 
 def stem_document(document):
@@ -75,12 +120,20 @@ def stem_document(document):
     """
 
     stem_mappings = {}
+    word_stems = {}
     words = document.split()
 
     for word in words:
-        stem = stem_word(word)
-        stem_mappings[stem] = (stem_mappings.get(stem, []) +
-                               [word.strip(get_extraneous_chars())])
+        word = word.strip(_EXTRANEOUS_CHARS)
+
+        # Documents repeat most of their words, so stem each
+        # distinct form only once and reuse it thereafter.
+        stem = word_stems.get(word)
+
+        if stem is None:
+            stem = word_stems[word] = stem_word(word)
+
+        stem_mappings.setdefault(stem, []).append(word)
 
     return stem_mappings
 
@@ -92,7 +145,7 @@ def load_dictionary():
 
     Returns
     -------
-    english_dict : set
+    english_dict : frozenset
         The set of valid English words.
     """
 
@@ -105,7 +158,7 @@ def load_dictionary():
     dictionary = os.path.join(directory, "dictionary.txt")
 
     with open(dictionary, "r") as f:
-        return {word.strip() for word in f}
+        return frozenset(f.read().split())
 
 
 @memoize
@@ -165,46 +218,52 @@ def stem_word(word):
         The stem produced from parsing this word.
     """
 
-    word = normalize_word(word)
-    if not is_valid_word(word):
+    return _stem_normalized_word(normalize_word(word))
+
+
+@memoize(maxsize=200000)
+def _stem_normalized_word(word):
+    """
+    Stem a word that has already been normalized.
+
+    Results are memoized by normalized word, so forms of a word that differ
+    only in case or surrounding punctuation share a single cache entry.
+
+    Parameters
+    ----------
+    word : str
+        The normalized word that we are to stem.
+
+    Returns
+    -------
+    word_stem : str
+        The stem produced from parsing this word.
+    """
+
+    # Words like these are too small, and none
+    # of them are exceptions, so skip all lookups.
+    if len(word) <= 2:
+        return word
+
+    word_dict = load_dictionary()
+
+    if word not in word_dict:
         return word
 
     exception_mappings = get_exceptions()
     if word in exception_mappings:
         return exception_mappings[word]
 
-    # Words like these are too small
-    if len(word) <= 2:
-        return word
-
     # We want to return an actual word
     # as the stem, so we need to keep
     # track of our last known valid word.
     current_word = word
 
-    word = apply_rule_1a(word)
-    current_word = word if is_valid_word(word) else current_word
+    for apply_rule in _RULES:
+        word = apply_rule(word)
 
-    word = apply_rule_1b(word)
-    current_word = word if is_valid_word(word) else current_word
-
-    word = apply_rule_1c(word)
-    current_word = word if is_valid_word(word) else current_word
-
-    word = apply_rule_2(word)
-    current_word = word if is_valid_word(word) else current_word
-
-    word = apply_rule_3(word)
-    current_word = word if is_valid_word(word) else current_word
-
-    word = apply_rule_4(word)
-    current_word = word if is_valid_word(word) else current_word
-
-    word = apply_rule_5a(word)
-    current_word = word if is_valid_word(word) else current_word
-
-    word = apply_rule_5b(word)
-    current_word = word if is_valid_word(word) else current_word
+        if word in word_dict:
+            current_word = word
 
     return current_word
 
@@ -219,7 +278,7 @@ def get_extraneous_chars():
         A string containing all extraneous characters we can remove.
     """
 
-    return " \t\n\r!?.,()@#&*^\"\'~[]"
+    return _EXTRANEOUS_CHARS
 
 
 def normalize_word(word):
@@ -237,10 +296,7 @@ def normalize_word(word):
         The normalized version of the word.
     """
 
-    word = word.lower()
-    word = word.strip(get_extraneous_chars())
-
-    return word
+    return word.lower().strip(_EXTRANEOUS_CHARS)
 
 
 def is_valid_word(word):
@@ -262,6 +318,49 @@ def is_valid_word(word):
     return word in word_dict
 
 
+# Letters that are always vowels per Porter (1980).
+_VOWELS = frozenset("aeiou")
+
+# Letters that cannot end a CVC pattern per Porter (1980).
+_NON_CVC_ENDINGS = frozenset("wxy")
+
+
+def _consonant_mask(word):
+    """
+    Compute a bitmask of the consonants in a word.
+
+    Bit `i` of the mask is set if the letter at index `i` of `word` is a
+    consonant per Porter (1980). Whether a "y" is a consonant only depends
+    on the letter before it, so a single left-to-right pass suffices.
+
+    Parameters
+    ----------
+    word : str
+        The word whose letters we are classifying. Assumed lowercase.
+
+    Returns
+    -------
+    consonant_mask : int
+        The bitmask of consonant positions in the word.
+    """
+
+    mask = 0
+    consonant = False
+
+    for i, letter in enumerate(word):
+        if letter in _VOWELS:
+            consonant = False
+        elif letter == "y":
+            consonant = not consonant
+        else:
+            consonant = True
+
+        if consonant:
+            mask |= 1 << i
+
+    return mask
+
+
 def is_consonant(word, i):
     """
     Check if the letter at index `i` of `word` is a consonant.
@@ -286,21 +385,13 @@ def is_consonant(word, i):
         Whether or not the letter at the index in the word is a consonant.
     """
 
-    vowels = {"a", "e", "i", "o", "u"}
+    if i < 0:
+        i += len(word)
 
-    if word[i] in vowels:
-        return False
-
-    if word[i] == "y":
-        if i == 0:
-            return True
-        else:
-            return not (is_consonant(word, i - 1))
-
-    return True
+    return bool(_consonant_mask(word[:i + 1]) >> i & 1)
 
 
-def contains_vowel(stem):
+def contains_vowel(stem, mask=None):
     """
     Check whether a stem contains a vowel.
 
@@ -308,6 +399,9 @@ def contains_vowel(stem):
     ----------
     stem : str
         The stem that we are checking. We assume all letters are lowercase.
+    mask : int, optional
+        The consonant mask of `stem` or of any word that starts with `stem`.
+        If not provided, it is computed from `stem`.
 
     Returns
     -------
@@ -315,14 +409,14 @@ def contains_vowel(stem):
         Whether or not the stem contains a vowel.
     """
 
-    for i in range(len(stem)):
-        if not is_consonant(stem, i):
-            return True
+    if mask is None:
+        mask = _consonant_mask(stem)
 
-    return False
+    all_consonants = (1 << len(stem)) - 1
+    return (mask & all_consonants) != all_consonants
 
 
-def ends_double_consonant(word):
+def ends_double_consonant(word, mask=None):
     """
     Check whether a word ends with a double consonant.
 
@@ -330,6 +424,9 @@ def ends_double_consonant(word):
     ----------
     word : str
         The word to check. We assume all letters are lowercase.
+    mask : int, optional
+        The consonant mask of `word` or of any word that starts with `word`.
+        If not provided, it is computed from `word`.
 
     Returns
     -------
@@ -337,14 +434,16 @@ def ends_double_consonant(word):
         Whether or not the word ends with a double consonant.
     """
 
-    if len(word) >= 2:
-        if word[-1] == word[-2]:
-            return is_consonant(word, len(word) - 1)
+    if len(word) >= 2 and word[-1] == word[-2]:
+        if mask is None:
+            mask = _consonant_mask(word)
+
+        return bool(mask >> (len(word) - 1) & 1)
 
     return False
 
 
-def ends_cvc(word):
+def ends_cvc(word, mask=None):
     """
     Check whether a word ends with a CVC pattern.
 
@@ -359,6 +458,9 @@ def ends_cvc(word):
     ----------
     word : str
         The word to check. We assume all letters are lowercase.
+    mask : int, optional
+        The consonant mask of `word` or of any word that starts with `word`.
+        If not provided, it is computed from `word`.
 
     Returns
     -------
@@ -366,19 +468,22 @@ def ends_cvc(word):
         Whether or not the word ends with a CVC pattern.
     """
 
-    if len(word) == 2:
-        return not is_consonant(word, 0) and is_consonant(word, 1)
+    if len(word) < 2:
+        return False
 
-    elif len(word) >= 3:
-        return (is_consonant(word, len(word) - 3) and
-                not is_consonant(word, len(word) - 2) and
-                is_consonant(word, len(word) - 1) and
-                word[-1] not in {"w", "x", "y"})
+    if mask is None:
+        mask = _consonant_mask(word)
 
-    return False
+    if len(word) == 2:
+        # Vowel at index 0, consonant at index 1.
+        return (mask & 0b11) == 0b10
 
+    # Consonant, vowel, consonant in the last three letters.
+    return ((mask >> (len(word) - 3) & 0b111) == 0b101 and
+            word[-1] not in _NON_CVC_ENDINGS)
 
-def measure(stem):
+
+def measure(stem, mask=None):
     """
     Return the measure of a stem.
 
@@ -393,15 +498,127 @@ def measure(stem):
     ----------
     stem : str
         The stem that we are to measure. We assume all letters are lowercase.
+    mask : int, optional
+        The consonant mask of `stem` or of any word that starts with `stem`.
+        If not provided, it is computed from `stem`.
+
+    Returns
+    -------
+    stem_measure : int
+        The measure of the stem.
+    """
+
+    if mask is None:
+        mask = _consonant_mask(stem)
+
+    return _prefix_measure(_vc_pair_mask(mask), len(stem))
+
+
+def _vc_pair_mask(mask):
+    """
+    Compute a bitmask of the vowel-consonant pairs in a word.
+
+    Parameters
+    ----------
+    mask : int
+        The consonant mask of the word.
+
+    Returns
+    -------
+    vc_pair_mask : int
+        The bitmask in which bit `i` is set if the letter at index `i` is a
+        vowel and the letter at index `i + 1` is a consonant.
+    """
+
+    return ~mask & (mask >> 1)
+
+
+def _prefix_measure(vc_pairs, length):
+    """
+    Return the measure of the first `length` letters of a word.
+
+    This allows the rules to measure every candidate stem of a word from a
+    single vowel-consonant pair mask, without slicing out the stem first.
+
+    Parameters
+    ----------
+    vc_pairs : int
+        The vowel-consonant pair mask of the word.
+    length : int
+        The number of letters at the start of the word to measure.
+
+    Returns
+    -------
+    prefix_measure : int
+        The measure of the first `length` letters of the word.
     """
 
-    cv_sequence = ""
+    # A pair starting at index `i` is only in the prefix if `i + 1 < length`.
+    return bin(vc_pairs & ((1 << max(length - 1, 0)) - 1)).count("1")
+
+
+def _build_suffix_trie(rules):
+    """
+    Build a trie of reversed suffixes for matching the ends of words.
+
+    Parameters
+    ----------
+    rules : list
+        A list of (suffix, replacement) tuples.
+
+    Returns
+    -------
+    suffix_trie : dict
+        Nested dictionaries keyed by letter, starting from the last letter
+        of each suffix. The node at which a suffix ends stores the tuple
+        (len(suffix), replacement) under the key `None`.
+    """
 
-    for i in range(len(stem)):
-        consonant = is_consonant(stem, i)
-        cv_sequence += "c" if consonant else "v"
+    suffix_trie = {}
 
-    return cv_sequence.count("vc")
+    for suffix, replacement in rules:
+        node = suffix_trie
+
+        for letter in reversed(suffix):
+            node = node.setdefault(letter, {})
+
+        node[None] = (len(suffix), replacement)
+
+    return suffix_trie
+
+
+def _match_suffixes(suffix_trie, word):
+    """
+    Find all suffixes in a suffix trie that the word ends with.
+
+    Parameters
+    ----------
+    suffix_trie : dict
+        The suffix trie, as built by `_build_suffix_trie`.
+    word : str
+        The word to match. We assume all letters are lowercase.
+
+    Returns
+    -------
+    suffix_matches : list
+        The (suffix_length, replacement) tuples of all matching suffixes,
+        ordered from the longest suffix to the shortest.
+    """
+
+    suffix_matches = []
+    node = suffix_trie
+
+    for letter in reversed(word):
+        node = node.get(letter)
+
+        if node is None:
+            break
+
+        if None in node:
+            suffix_matches.append(node[None])
+
+    suffix_matches.reverse()
+    return suffix_matches
 
 
 def apply_rule_1a(word):
@@ -503,10 +720,12 @@ def apply_rule_1b(word):
             # "ied" --> "i"
             return word[:-2]
 
+    mask = _consonant_mask(word)
+
     # "eed" --> "ee" if measure > 0, else return original word
     if word.endswith("eed"):
         stem = word[:-3]
-        return stem + "ee" if measure(stem) > 0 else word
+        return stem + "ee" if measure(stem, mask) > 0 else word
 
     # "ed" --> "" if stem contains vowel, else return original word
     # "ing" --> "" if stem contains vowel, else return original word
@@ -516,7 +735,7 @@ def apply_rule_1b(word):
         if word.endswith(suffix):
             test_stem = word[:-len(suffix)]
 
-            if contains_vowel(test_stem):
+            if contains_vowel(test_stem, mask):
                 stem = test_stem
                 break
 
@@ -530,11 +749,11 @@ def apply_rule_1b(word):
         return stem + "e"
 
     # double-consonant --> single consonant if not "l", "s", or "z"
-    if ends_double_consonant(stem) and stem[-1] not in {"l", "s", "z"}:
+    if ends_double_consonant(stem, mask) and stem[-1] not in {"l", "s", "z"}:
         return stem[:-1]
 
     # add "e" to end of word if stem measure is 1 and ends with CVC
-    if measure(stem) == 1 and ends_cvc(stem):
+    if measure(stem, mask) == 1 and ends_cvc(stem, mask):
         return stem + "e"
 
     # add "e" to end of word in special cases where the past tense is "ed"
@@ -574,12 +793,37 @@ def apply_rule_1c(word):
     if word.endswith("y"):
         stem = word[:-1]
 
-        if len(stem) > 1 and is_consonant(stem, len(stem) - 1):
+        if len(stem) > 1 and _consonant_mask(stem) >> (len(stem) - 1) & 1:
             return stem + "i"
 
     return word
 
 
+_RULE_2_TRIE = _build_suffix_trie([
+    ("ational", "ate"),
+    ("tional", "tion"),
+    ("enci", "ence"),
+    ("anci", "ance"),
+    ("izer", "ize"),
+    ("bli", "ble"),
+    ("alli", "al"),
+    ("entli", "ent"),
+    ("eli", "e"),
+    ("ousli", "ous"),
+    ("ization", "ize"),
+    ("ation", "ate"),
+    ("ator", "ate"),
+    ("alism", "al"),
+    ("iveness", "ive"),
+    ("fulness", "ful"),
+    ("ousness", "ous"),
+    ("aliti", "al"),
+    ("iviti", "ive"),
+    ("biliti", "ble"),
+    ("fulli", "ful"),
+])
+
+
 def apply_rule_2(word):
     """
     Apply Rule 2 from Porter (1980).
@@ -617,44 +861,37 @@ def apply_rule_2(word):
         The word processed with Rule 2.
     """
 
+    vc_pairs = _vc_pair_mask(_consonant_mask(word))
+
     # "alli" --> "al" and then re-apply Rule 2.
-    if word.endswith("alli") and measure(word[:-4]) > 0:
+    if word.endswith("alli") and _prefix_measure(vc_pairs, len(word) - 4) > 0:
         return apply_rule_2(word[:-2])
 
-    for suffix, replacement in [
-        ("ational", "ate"),
-        ("tional", "tion"),
-        ("enci", "ence"),
-        ("anci", "ance"),
-        ("izer", "ize"),
-        ("bli", "ble"),
-        ("alli", "al"),
-        ("entli", "ent"),
-        ("eli", "e"),
-        ("ousli", "ous"),
-        ("ization", "ize"),
-        ("ation", "ate"),
-        ("ator", "ate"),
-        ("alism", "al"),
-        ("iveness", "ive"),
-        ("fulness", "ful"),
-        ("ousness", "ous"),
-        ("aliti", "al"),
-        ("iviti", "ive"),
-        ("biliti", "ble"),
-        ("fulli", "ful"),
-    ]:
-        if word.endswith(suffix) and measure(word[:-len(suffix)]) > 0:
-            return word[:-len(suffix)] + replacement
+    for suffix_length, replacement in _match_suffixes(_RULE_2_TRIE, word):
+        stem_length = len(word) - suffix_length
+
+        if _prefix_measure(vc_pairs, stem_length) > 0:
+            return word[:stem_length] + replacement
 
     # "logi" --> "log" (include "l" in stem for consistency between
     # shorter stems like "geo" and longer ones like "philo").
-    if word.endswith("logi") and measure(word[:-3]) > 0:
+    if word.endswith("logi") and _prefix_measure(vc_pairs, len(word) - 3) > 0:
         return word[:-1]
 
     return word
 
 
+_RULE_3_TRIE = _build_suffix_trie([
+    ("icate", "ic"),
+    ("ative", ""),
+    ("alize", "al"),
+    ("iciti", "ic"),
+    ("ical", "ic"),
+    ("ful", ""),
+    ("ness", ""),
+])
+
+
 def apply_rule_3(word):
     """
     Apply Rule 3 from Porter (1980).
@@ -678,21 +915,27 @@ def apply_rule_3(word):
         The word processed with Rule 3.
     """
 
-    for suffix, replacement in [
-        ("icate", "ic"),
-        ("ative", ""),
-        ("alize", "al"),
-        ("iciti", "ic"),
-        ("ical", "ic"),
-        ("ful", ""),
-        ("ness", ""),
-    ]:
-        if word.endswith(suffix) and measure(word[:-len(suffix)]) > 0:
-            return word[:-len(suffix)] + replacement
+    vc_pairs = _vc_pair_mask(_consonant_mask(word))
+
+    for suffix_length, replacement in _match_suffixes(_RULE_3_TRIE, word):
+        stem_length = len(word) - suffix_length
+
+        if _prefix_measure(vc_pairs, stem_length) > 0:
+            return word[:stem_length] + replacement
 
     return word
 
 
+_RULE_4_TRIE = _build_suffix_trie(
+    (suffix, "") for suffix in ["al", "ance", "ence", "er", "ic", "able",
+                                "ible", "ant", "ement", "ment", "ent"])
+
+# Checked only after the special "ion" and "iou" handling in Rule 4.
+_RULE_4_LATE_TRIE = _build_suffix_trie(
+    (suffix, "") for suffix in ["ou", "ism", "ate", "iti", "ous", "ive",
+                                "ize"])
+
+
 def apply_rule_4(word):
     """
     Apply Rule 4 from Porter (1980).
@@ -732,24 +975,29 @@ def apply_rule_4(word):
         The word processed with Rule 4.
     """
 
-    for suffix in ["al", "ance", "ence", "er", "ic", "able",
-                   "ible", "ant", "ement", "ment", "ent"]:
-        if word.endswith(suffix) and measure(word[:-len(suffix)]) > 1:
-            return word[:-len(suffix)]
+    vc_pairs = _vc_pair_mask(_consonant_mask(word))
+
+    for suffix_length, _ in _match_suffixes(_RULE_4_TRIE, word):
+        stem_length = len(word) - suffix_length
+
+        if _prefix_measure(vc_pairs, stem_length) > 1:
+            return word[:stem_length]
 
     if word.endswith("ion"):
         stem = word[:-3]
 
-        if measure(stem) > 1 and stem[-1] in {"s", "t"}:
+        if _prefix_measure(vc_pairs, len(stem)) > 1 and stem[-1] in {"s", "t"}:
             return stem
 
     for suffix in ["iou", "ious"]:
         if word.endswith(suffix) and is_valid_word(word[:-len(suffix)] + "e"):
             return word[:-len(suffix)] + "e"
 
-    for suffix in ["ou", "ism", "ate", "iti", "ous", "ive", "ize"]:
-        if word.endswith(suffix) and measure(word[:-len(suffix)]) > 1:
-            return word[:-len(suffix)]
+    for suffix_length, _ in _match_suffixes(_RULE_4_LATE_TRIE, word):
+        stem_length = len(word) - suffix_length
+
+        if _prefix_measure(vc_pairs, stem_length) > 1:
+            return word[:stem_length]
 
     return word
 
@@ -784,10 +1032,13 @@ def apply_rule_5a(word):
         if is_valid_word(stem + "ious"):
             return word
 
-        if measure(stem) > 1:
+        mask = _consonant_mask(stem)
+        stem_measure = measure(stem, mask)
+
+        if stem_measure > 1:
             return stem
 
-        if measure(stem) == 1 and not ends_cvc(stem):
+        if stem_measure == 1 and not ends_cvc(stem, mask):
             return stem
 
     return word
@@ -817,3 +1068,16 @@ def apply_rule_5b(word):
         return word[:-1]
 
     return word
+
+
+# The rules from Porter (1980), in the order `stem_word` applies them.
+_RULES = (
+    apply_rule_1a,
+    apply_rule_1b,
+    apply_rule_1c,
+    apply_rule_2,
+    apply_rule_3,
+    apply_rule_4,
+    apply_rule_5a,
+    apply_rule_5b,
+)
@@ -4,19 +4,41 @@ Main web application for the user to provide documents for word counting.
 
 from flask import (Flask, Markup, g, make_response, render_template, redirect,
                    request, url_for)
-from .stemming import get_top_stems, stem_document
+from flask_compress import Compress
+from .stemming import (get_exceptions, get_top_stems, load_dictionary,
+                       stem_document)
 
+import json
 import os
+import re
 import uuid
 import sqlite3
+import threading
+import zlib
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 
+# Highlighted documents from /match can be large, so compress responses
+# for clients that accept it.
+Compress(app)
+
 app.config.update(dict(
     DATABASE=os.path.join(app.root_path, "stemming.db")
 ))
 
+# Database connections are kept open across requests, one per thread.
+_connections = threading.local()
+
+# The number of top stems shown for a document, whether they are read back
+# from the database or computed from a freshly stemmed document.
+_TOP_STEMS = 25
+
+# Load the stemmer's word tables when the app is imported (i.e. when each
+# worker boots), so the first request does not pay to read the dictionary.
+load_dictionary()
+get_exceptions()
+
 
 def connect_db():
     """
@@ -30,6 +52,10 @@ def connect_db():
 
     rv = sqlite3.connect(app.config["DATABASE"])
     rv.row_factory = sqlite3.Row
+
+    # In WAL mode (see `init_db`), this only syncs on checkpoints
+    # instead of on every commit, and it is not persisted in the file.
+    rv.execute("PRAGMA synchronous=NORMAL")
     return rv
 
 
@@ -37,6 +63,9 @@ def get_db():
     """
     Get the database connection and store in the global state.
 
+    The connection is reused by subsequent requests on the same thread, as
+    long as the configured database has not changed.
+
     Returns
     -------
     db_conn : sqlite3.Connection
@@ -44,19 +73,48 @@ def get_db():
     """
 
     if not hasattr(g, "sqlite_db"):
-        g.sqlite_db = connect_db()
+        database = app.config["DATABASE"]
+
+        if getattr(_connections, "database", None) != database:
+            disconnect_db()
+
+            _connections.db = connect_db()
+            _connections.database = database
+
+        g.sqlite_db = _connections.db
 
     return g.sqlite_db
 
 
+def disconnect_db():
+    """
+    Close this thread's database connection, if it has one.
+
+    The next call to `get_db` on this thread opens a new connection. This
+    must be called before the database file is removed, as an open
+    connection keeps the WAL and shared-memory files next to it.
+    """
+
+    db = getattr(_connections, "db", None)
+
+    if db is not None:
+        db.close()
+
+    _connections.db = None
+    _connections.database = None
+
+
 @app.teardown_appcontext
 def close_db(_):
     """
-    Close the connection to the database.
+    Release the connection to the database.
+
+    The connection stays open for the next request on this thread, so we
+    only roll back anything that was left uncommitted.
     """
 
     if hasattr(g, "sqlite_db"):
-        g.sqlite_db.close()
+        g.sqlite_db.rollback()
 
 
 def init_db():
@@ -71,6 +129,10 @@ def init_db():
 
     db.commit()
 
+    # The journal mode is persisted in the database file, so it only needs
+    # to be set once. Readers no longer block on writers in WAL mode.
+    db.execute("PRAGMA journal_mode=WAL")
+
 
 def init_db_if_not_exists():
     """
@@ -87,6 +149,39 @@ def init_db_if_not_exists():
         init_db()
 
 
+def highlight_matches(document, matches):
+    """
+    Wrap every occurrence of the given matches in a document with a span.
+
+    The document is scanned once, trying longer matches first, so that a
+    match that is a substring of another match (or of the span markup
+    already inserted) cannot split it.
+
+    Parameters
+    ----------
+    document : str
+        The document in which to highlight matches.
+    matches : iterable
+        The words to highlight in the document.
+
+    Returns
+    -------
+    highlighted_document : str
+        The document with each match wrapped in a "match" span.
+    """
+
+    matches = sorted({stem_match for stem_match in matches if stem_match},
+                     key=len, reverse=True)
+
+    if not matches:
+        return document
+
+    pattern = re.compile("|".join(re.escape(stem_match)
+                                  for stem_match in matches))
+
+    return pattern.sub(r"<span class='match'>\g<0></span>", document)
+
+
 @app.cli.command("initdb")
 def initdb_command():
     """
@@ -108,15 +203,84 @@ def index():
     return response
 
 
+def store_matches(doc_id, document):
+    """
+    Stem a document and store the stem-word matches in the database.
+
+    The matches are not committed, so that the caller can commit them in the
+    same transaction as any other changes.
+
+    Parameters
+    ----------
+    doc_id : str
+        The ID of the document.
+    document : str
+        The text of the document to stem.
+
+    Returns
+    -------
+    stem_mappings : dict
+        A mapping from stem to list of words whose stem was the same.
+    """
+
+    matches = stem_document(document)
+
+    # Two requests can stem the same document at the same time, so replace
+    # any matches that were already stored instead of failing.
+    cmd = ("INSERT OR REPLACE INTO matches (doc_id, stem, stem_count, "
+           "matches) values (?, ?, ?, ?)")
+    rows = [(doc_id, stem, len(stem_matches),
+             json.dumps(sorted(set(stem_matches))))
+            for stem, stem_matches in matches.items()]
+
+    get_db().executemany(cmd, rows)
+    return matches
+
+
+def get_stored_top_stems(doc_id, k=25):
+    """
+    Get the top `k` stems of a document from its stored stem-word matches.
+
+    This mirrors `get_top_stems`, including keeping stems that are tied with
+    the `k`-th stem, without having to load every stem of the document.
+
+    Parameters
+    ----------
+    doc_id : str
+        The ID of the document.
+    k : int, default 25
+        The number of top stems to choose.
+
+    Returns
+    -------
+    top_stems : list
+        A list of (stem, count) tuples, sorted by count and then by stem in
+        descending order. The list is empty if no matches are stored.
+    """
+
+    # SQLite treats a negative offset as zero.
+    if k <= 0:
+        return []
+
+    cmd = ("SELECT stem, stem_count FROM matches WHERE doc_id=? AND "
+           "stem_count >= COALESCE((SELECT stem_count FROM matches WHERE "
+           "doc_id=? ORDER BY stem_count DESC, stem DESC LIMIT 1 OFFSET ?), "
+           "0) ORDER BY stem_count DESC, stem DESC")
+    cur = get_db().execute(cmd, [doc_id, doc_id, k - 1])
+
+    return [(row["stem"], row["stem_count"]) for row in cur]
+
+
 @app.route("/submit", methods=["POST"])
 def submit():
     """
     Submit endpoint.
 
-    This takes the provided document and stores it.
+    This takes the provided document, stores it, and then stems it and
+    stores the stem-word matches.
     """
 
-    doc_id = str(uuid.uuid4())
+    doc_id = uuid.uuid4().hex
     document = request.form["document"]
 
     init_db_if_not_exists()
@@ -125,9 +289,10 @@ def submit():
     cmd = "INSERT INTO documents (doc_id, doc_text) values (?, ?)"
 
     db.execute(cmd, [doc_id, document])
+    store_matches(doc_id, document)
     db.commit()
 
-    response = redirect(url_for("display", **{"id": doc_id}))
+    response = redirect(url_for("display", id=doc_id))
     response.headers["X-Frame-Options"] = "SAMEORIGIN"
     return response
 
@@ -137,38 +302,35 @@ def display():
     """
     Display endpoint.
 
-    This takes the provided document, stems it, stores the stem-word matches,
-    and then displays the stems and the number of words associated with it.
+    This displays the top stems of the provided document and the number of
+    words associated with each. Documents whose stem-word matches were not
+    stored when they were submitted are stemmed and stored here.
     """
 
     init_db_if_not_exists()
     db = get_db()
 
-    document = None
     doc_id = request.args.get("id")
 
-    if doc_id is not None:
+    if doc_id is None:
+        return redirect(url_for("index"))
+
+    top_stems = get_stored_top_stems(doc_id, k=_TOP_STEMS)
+
+    if not top_stems:
         cmd = "SELECT doc_text FROM documents WHERE doc_id=?"
         cur = db.execute(cmd, [doc_id])
 
         document = cur.fetchone()
-        if document is not None:
-            document = document["doc_text"]
-
-    if doc_id is None or document is None:
-        return redirect(url_for("index"))
-
-    matches = stem_document(document)
-    top_stems = get_top_stems(matches)
 
-    cmd = "INSERT INTO matches (doc_id, stem, matches) values (?, ?, ?)"
+        if document is None:
+            return redirect(url_for("index"))
 
-    for stem, stem_matches in matches.items():
-        matches = ",".join(stem_matches)
-
-        db.execute(cmd, [doc_id, stem, matches])
+        matches = store_matches(doc_id, document["doc_text"])
         db.commit()
 
+        top_stems = get_top_stems(matches, k=_TOP_STEMS)
+
     response = make_response(render_template("result.html", stems=top_stems))
     response.headers["X-Frame-Options"] = "SAMEORIGIN"
     return response
@@ -186,22 +348,17 @@ def match():
     init_db_if_not_exists()
     db = get_db()
 
-    document = None
     stem = request.args.get("stem")
     doc_id = request.args.get("id")
 
-    if not (stem is None or doc_id is None):
-        cmd = "SELECT doc_text FROM documents WHERE doc_id=?"
-        cur = db.execute(cmd, [doc_id])
-
-        document = cur.fetchone()
-        if document is not None:
-            document = document["doc_text"]
-
-    if stem is None or doc_id is None or document is None:
+    if stem is None or doc_id is None:
         return redirect(url_for("index"))
 
-    cmd = "SELECT matches FROM matches WHERE doc_id=? AND stem=?"
+    # The document text is only needed if we have not yet stored the
+    # highlighted document for this stem, so we avoid reading it otherwise.
+    cmd = ("SELECT m.matches, m.highlighted, CASE WHEN m.highlighted IS NULL "
+           "THEN d.doc_text END AS doc_text FROM matches m JOIN documents d "
+           "ON d.doc_id = m.doc_id WHERE m.doc_id=? AND m.stem=?")
     cur = db.execute(cmd, [doc_id, stem])
 
     matches = cur.fetchone()
@@ -209,12 +366,20 @@ def match():
     if matches is None:
         return redirect(url_for("index"))
 
-    matches = matches["matches"]
-    matches = set(matches.split(","))
+    # The highlighted document is computed the first time a stem's matches
+    # are requested, and it is stored compressed for any subsequent requests.
+    if matches["highlighted"] is None:
+        document = highlight_matches(matches["doc_text"],
+                                     json.loads(matches["matches"]))
+        highlighted = zlib.compress(document.encode("utf-8"))
 
-    for stem_match in matches:
-        document = document.replace(stem_match, ("<span class='match'>"
-                                                 + stem_match + "</span>"))
+        cmd = "UPDATE matches SET highlighted=? WHERE doc_id=? AND stem=?"
+
+        db.execute(cmd, [sqlite3.Binary(highlighted), doc_id, stem])
+        db.commit()
+    else:
+        highlighted = bytes(matches["highlighted"])
+        document = zlib.decompress(highlighted).decode("utf-8")
 
     response = make_response(render_template(
         "match.html", document=Markup(document), stem=stem))
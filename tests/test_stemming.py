@@ -7,12 +7,70 @@ from stemming.stemming import (apply_rule_1a, apply_rule_1b, apply_rule_1c,
                                apply_rule_5a, apply_rule_5b, contains_vowel,
                                ends_cvc, ends_double_consonant, get_exceptions,
                                get_extraneous_chars, get_top_stems,
-                               is_consonant, is_valid_word, measure,
+                               is_consonant, is_valid_word, measure, memoize,
                                normalize_word, stem_document, stem_word)
 
 import pytest
 
 
+class TestMemoize(object):
+
+    def test_memoize(self):
+        calls = []
+
+        @memoize
+        def double(x):
+            calls.append(x)
+            return 2 * x
+
+        assert double(1) == 2
+        assert double(1) == 2
+        assert calls == [1]
+
+    def test_memoize_kwargs(self):
+        calls = []
+
+        @memoize
+        def add(x, y=0):
+            calls.append((x, y))
+            return x + y
+
+        assert add(1, y=2) == 3
+        assert add(1, y=3) == 4
+        assert add(1, y=2) == 3
+        assert add(1, 2) == 3
+        assert calls == [(1, 2), (1, 3), (1, 2)]
+
+    def test_memoize_maxsize(self):
+        calls = []
+
+        @memoize(maxsize=2)
+        def double(x):
+            calls.append(x)
+            return 2 * x
+
+        assert [double(x) for x in (1, 2, 1, 3, 1)] == [2, 4, 2, 6, 2]
+        assert calls == [1, 2, 3]
+
+        # 3 is evicted to make room for 2, as 1 was used more recently.
+        assert [double(x) for x in (2, 1)] == [4, 2]
+        assert calls == [1, 2, 3, 2]
+
+    def test_memoize_maxsize_hot_key(self):
+        calls = []
+
+        @memoize(maxsize=3)
+        def upper(word):
+            calls.append(word)
+            return word.upper()
+
+        words = ["the", "a", "the", "b", "the", "c", "the", "d", "the"]
+        assert [upper(word) for word in words] == [w.upper() for w in words]
+
+        # "the" keeps being used, so it is never evicted.
+        assert calls == ["the", "a", "b", "c", "d"]
+
+
 class TestTopStems(object):
 
     def test_few_mappings(self):
@@ -39,6 +97,20 @@ class TestTopStems(object):
         actual = get_top_stems(stem_mappings)
         assert actual == expected
 
+    def test_k_mappings(self):
+        stem_mappings = {"stem{i}".format(i=i): ["a"] * i for i in range(26)}
+
+        expected = [("stem25", 25), ("stem24", 24), ("stem23", 23)]
+        actual = get_top_stems(stem_mappings, k=3)
+        assert actual == expected
+
+        expected = [("stem5", 5), ("stem4", 5)]
+        actual = get_top_stems({"stem4": ["a"] * 5, "stem5": ["a"] * 5,
+                                "stem1": ["a"]}, k=1)
+        assert actual == expected
+
+        assert get_top_stems(stem_mappings, k=0) == []
+
 
 class TestStemDocument(object):
 
@@ -77,6 +149,14 @@ class TestStemDocument(object):
 
         assert stem_document(document) == expected
 
+    def test_stem_doc_repeated(self):
+        document = "talks Talk talks, talk talks"
+        expected = {
+            "talk": ["talks", "Talk", "talks", "talk", "talks"],
+        }
+
+        assert stem_document(document) == expected
+
 
 class TestStemWord(object):
 
@@ -4,10 +4,15 @@ Tests for the web application views.
 
 from flask import abort  # noqa
 from tempfile import mkstemp
-from stemming.webapp import app, init_db, get_db
+from stemming.stemming import get_top_stems
+from stemming.webapp import (app, disconnect_db, get_db,
+                             get_stored_top_stems, highlight_matches, init_db)
 
+import json
 import os
 import pytest
+import sqlite3
+import zlib
 
 
 class WebAppTest(object):
@@ -18,21 +23,64 @@ class WebAppTest(object):
         cls.client = app.test_client()
         app.config["TESTING"] = True
 
-    def setup_method(self, _):
-        # For tests that just query data, this setup is sufficient.
-        # However, for tests that write to the database, it is necessary
-        # to run the entire test under the app_context, including creating,
-        # writing, and querying, as the database state expires once you
-        # leave the app_context.
+        # For tests that just query data, creating the schema once for
+        # the class is sufficient. However, tests that write to the
+        # database must reinitialize it themselves, so that they start
+        # from empty tables regardless of what earlier tests wrote.
         with app.app_context():
             init_db()
 
     @classmethod
     def teardown_class(cls):
+        # The connection outlives the app_context, so close it before
+        # removing the database, or its WAL files are left behind.
+        disconnect_db()
+
         os.close(cls.db_fd)
         os.unlink(app.config['DATABASE'])
 
 
+class TestGetDb(WebAppTest):
+
+    def test_reuse_connection(self):
+        with app.app_context():
+            db = get_db()
+
+        with app.app_context():
+            assert get_db() is db
+
+    def test_change_database(self):
+        with app.app_context():
+            db = get_db()
+
+        db_fd, database = mkstemp()
+        original, app.config["DATABASE"] = app.config["DATABASE"], database
+
+        try:
+            with app.app_context():
+                assert get_db() is not db
+        finally:
+            disconnect_db()
+            app.config["DATABASE"] = original
+
+            os.close(db_fd)
+            os.unlink(database)
+
+    def test_disconnect(self):
+        with app.app_context():
+            init_db()
+            db = get_db()
+
+        disconnect_db()
+
+        # The WAL files are removed once the last connection is closed.
+        for suffix in ("-wal", "-shm"):
+            assert not os.path.exists(app.config["DATABASE"] + suffix)
+
+        with app.app_context():
+            assert get_db() is not db
+
+
 class TestIndex(WebAppTest):
 
     @classmethod
@@ -63,6 +111,13 @@ class TestIndex(WebAppTest):
         rv = self.client.post(self.url)
         self._check_data(rv.data)
 
+    def test_get_compressed(self):
+        rv = self.client.get(self.url, headers={"Accept-Encoding": "gzip"})
+        assert rv.headers["Content-Encoding"] == "gzip"
+
+        # Offset the window bits by 16 to decompress gzip rather than zlib.
+        self._check_data(zlib.decompress(rv.data, 16 + zlib.MAX_WBITS))
+
 
 class TestSubmit(WebAppTest):
 
@@ -92,6 +147,23 @@ class TestSubmit(WebAppTest):
         rv = self.client.post(self.url, data=self.data)
         assert b"Redirecting" in rv.data
 
+    def test_post_stores_matches(self):
+        with app.app_context():
+            init_db()
+
+            rv = self.client.post(self.url, data=self.data)
+            doc_id = rv.headers["Location"].split("id=")[-1]
+
+            cmd = ("SELECT stem, stem_count, matches FROM matches "
+                   "WHERE doc_id=? ORDER BY stem")
+            rows = get_db().execute(cmd, [doc_id]).fetchall()
+
+            assert [tuple(row) for row in rows] == [
+                ("cat", 1, json.dumps(["cat"])),
+                ("jump", 1, json.dumps(["jumped"])),
+                ("the", 1, json.dumps(["The"])),
+            ]
+
 
 class TestDisplay(WebAppTest):
 
@@ -158,6 +230,22 @@ class TestDisplay(WebAppTest):
             assert b"Top Words" in rv.data
             assert b"Number in parentheses" in rv.data
 
+    def test_get_refresh(self):
+        with app.app_context():
+            init_db()
+            db = get_db()
+
+            db.execute(self.cmd, [self.id, "The cat jumped"])
+            db.commit()
+
+            self.get(self.id)
+            rv = self.get(self.id)
+
+            assert b"cat (1)" in rv.data
+
+            cmd = "SELECT COUNT(*) FROM matches WHERE doc_id=?"
+            assert db.execute(cmd, [self.id]).fetchone()[0] == 3
+
     def test_post(self):
         # 405 error --> redirect to error page
         rv = self.client.post(self.url, data={"id": "123456789"})
@@ -172,8 +260,8 @@ class TestMatch(WebAppTest):
 
         cls.url = "/match"
         cls.doc_add = "INSERT INTO documents (doc_id, doc_text) values (?, ?)"
-        cls.stem_add = ("INSERT INTO matches (doc_id, stem, "
-                        "matches) values (?, ?, ?)")
+        cls.stem_add = ("INSERT INTO matches (doc_id, stem, stem_count, "
+                        "matches) values (?, ?, ?, ?)")
 
     def get(self, doc_id, stem):
         """
@@ -230,14 +318,14 @@ class TestMatch(WebAppTest):
 
             db.execute(self.doc_add, [doc_id, doc_text])
 
-            stem, stem_matches = "the", "The,the"
+            stem, stem_matches = "the", json.dumps(["The", "the"])
 
-            db.execute(self.stem_add, [doc_id, stem, stem_matches])
+            db.execute(self.stem_add, [doc_id, stem, 2, stem_matches])
             db.commit()
 
-            stem, stem_matches = "jump", "jumped"
+            stem, stem_matches = "jump", json.dumps(["jumped"])
 
-            db.execute(self.stem_add, [doc_id, stem, stem_matches])
+            db.execute(self.stem_add, [doc_id, stem, 1, stem_matches])
             db.commit()
 
             rv = self.get(doc_id, "the")
@@ -250,6 +338,56 @@ class TestMatch(WebAppTest):
             assert b"the</span>" not in rv.data
             assert b"jumped</span>" in rv.data
 
+    def test_get_highlighted(self):
+        with app.app_context():
+            init_db()
+            db = get_db()
+
+            doc_id = "123456789"
+            doc_text = "The cat jumped the fence."
+
+            db.execute(self.doc_add, [doc_id, doc_text])
+            db.execute(self.stem_add, [doc_id, "cat", 1,
+                                       json.dumps(["cat"])])
+            db.commit()
+
+            rv = self.get(doc_id, "cat")
+            assert b"cat</span>" in rv.data
+
+            cmd = "SELECT highlighted FROM matches WHERE doc_id=? AND stem=?"
+            highlighted = db.execute(cmd, [doc_id, "cat"]).fetchone()[0]
+
+            highlighted = zlib.decompress(bytes(highlighted)).decode("utf-8")
+            assert highlighted == ("The <span class='match'>cat</span> "
+                                   "jumped the fence.")
+
+            # Subsequent requests are served from the stored document.
+            cmd = "UPDATE matches SET highlighted=? WHERE doc_id=? AND stem=?"
+            highlighted = zlib.compress(b"stored document")
+
+            db.execute(cmd, [sqlite3.Binary(highlighted), doc_id, "cat"])
+            db.commit()
+
+            rv = self.get(doc_id, "cat")
+            assert b"stored document" in rv.data
+
+    def test_get_with_comma_stem(self):
+        with app.app_context():
+            init_db()
+            db = get_db()
+
+            doc_id = "123456789"
+            doc_text = "The well,known cat."
+
+            db.execute(self.doc_add, [doc_id, doc_text])
+            db.commit()
+
+            # Displaying the document stores its matches.
+            self.client.get("/display?id=" + doc_id)
+
+            rv = self.get(doc_id, "well,known")
+            assert b"<span class='match'>well,known</span>" in rv.data
+
     def test_post(self):
         # 405 error --> redirect to error page
         rv = self.client.post(self.url, data={"id": "123456789",
@@ -257,6 +395,89 @@ class TestMatch(WebAppTest):
         assert b"Redirecting" in rv.data
 
 
+class TestGetStoredTopStems(WebAppTest):
+
+    @staticmethod
+    def _store(stem_mappings, k=25):
+        """
+        Store stem-word matches for a document and get its top stems.
+
+        Parameters
+        ----------
+        stem_mappings : dict
+            The stem mappings to store.
+        k : int, default 25
+            The number of top stems to choose.
+
+        Returns
+        -------
+        top_stems : list
+            The top stems read back from the database.
+        """
+
+        doc_id = "123456789"
+        cmd = ("INSERT INTO matches (doc_id, stem, stem_count, matches) "
+               "values (?, ?, ?, ?)")
+
+        with app.app_context():
+            init_db()
+            db = get_db()
+
+            for stem, stem_matches in stem_mappings.items():
+                db.execute(cmd, [doc_id, stem, len(stem_matches),
+                                 json.dumps(stem_matches)])
+
+            db.commit()
+            return get_stored_top_stems(doc_id, k=k)
+
+    def test_no_mappings(self):
+        assert self._store({}) == []
+
+    def test_few_mappings(self):
+        stem_mappings = {"stem1": ["a", "b"], "stem2": ["a", "b", "c"]}
+        assert self._store(stem_mappings) == get_top_stems(stem_mappings)
+
+    def test_filter_mappings(self):
+        stem_mappings = {"stem{i}".format(i=i): ["a"] * i
+                         for i in range(1, 28)}
+        assert self._store(stem_mappings) == get_top_stems(stem_mappings)
+
+    def test_keep_mappings(self):
+        stem_mappings = {"stem{i}".format(i=i): ["a"] * i
+                         for i in range(1, 26)}
+        stem_mappings["stem0"] = ["a"]  # now tied for 25th place
+
+        top_stems = self._store(stem_mappings)
+
+        assert len(top_stems) == 26
+        assert top_stems == get_top_stems(stem_mappings)
+
+    @pytest.mark.parametrize("k", [0, 1, 3, 5, 10])
+    def test_k_mappings(self, k):
+        stem_mappings = {"stem{i}".format(i=i): ["a"] * (i // 2)
+                         for i in range(2, 12)}
+
+        top_stems = self._store(stem_mappings, k=k)
+        assert top_stems == get_top_stems(stem_mappings, k=k)
+
+
+class TestHighlightMatches(object):
+
+    def test_no_matches(self):
+        document = "The cat jumped the fence."
+        assert highlight_matches(document, []) == document
+        assert highlight_matches(document, [""]) == document
+
+    def test_overlapping_matches(self):
+        document = "a match in the matches"
+        expected = ("<span class='match'>a</span> <span class='match'>"
+                    "match</span> in the <span class='match'>matches</span>")
+
+        matches = ["a", "match", "matches"]
+
+        assert highlight_matches(document, matches) == expected
+
+
 class TestClientErrorHandling(WebAppTest):
 
     @pytest.mark.parametrize("method", ["get", "post"])